@@ -13,8 +13,18 @@
 
 import ephem
 import argparse
+import functools
 import math
-import json
+import sys
+
+# Use orjson to read the config file if it's available since it's a good deal faster,
+# otherwise fall back to the standard json module.
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    import json
+    _json_loads = lambda b: json.loads(b.decode())
 
 # Name of the JSON data file used to provide useable elements for special objects of 
 # interest, e.g. comets and satellites.  Also used to add additional cities as 
@@ -24,6 +34,24 @@ _objects_file = "objects.json"
 # Default city if one isn't specifed on the command line or in the config file
 _default_city = "Los Gatos"
 
+# Conjunction searches with at least this many bodies use NumPy (if it's installed)
+# to check all the pairs at once.  Below that, calling ephem.separation() for each
+# pair is quicker than importing NumPy in the first place.
+_NUMPY_MIN_BODIES = 400
+
+# Scale factors for converting angles, so we can multiply rather than divide by pi
+_RAD2DEG = 180.0 / math.pi    # radians to degrees
+_RAD2HR  = 12.0 / math.pi     # radians to hours (of right ascension)
+_DEG2RAD = math.pi / 180.0    # degrees to radians
+_RAD2ARCMIN = 60.0 * _RAD2DEG # radians to minutes of arc
+
+# The lunar phases in order, one per quarter of a lunation, with the function that
+# finds the most recent time the moon was at that phase
+_PHASE_TABLE = (("New Moon", ephem.previous_new_moon),
+                ("First Quarter", ephem.previous_first_quarter_moon),
+                ("Full Moon", ephem.previous_full_moon),
+                ("Last Quarter", ephem.previous_last_quarter_moon))
+
 
 # Here's the output table we want to generate:
 #
@@ -34,9 +62,8 @@ _default_city = "Los Gatos"
 
 # And a utility function to look up a city in our additional list
 def additional_city(name):
-    try:
-        data = _mycity_data[name]
-    except KeyError:
+    data = _mycity_data.get(name)
+    if data is None:
         raise KeyError('Unknown city: %r' % (name,))
     o = ephem.Observer()
     o.name = name
@@ -44,105 +71,172 @@ def additional_city(name):
     o.compute_pressure()
     return o
 
+# Find a city in either the list built into PyEphem or our additional list.  Both
+# build a new Observer (including calculating its air pressure) on every lookup, so
+# remember what we found for each city name.
+@functools.lru_cache(maxsize=128)
+def _find_site(name):
+    for resolver in (ephem.city, additional_city):
+        try:
+            return resolver(name)
+        except KeyError:
+            pass
+    raise KeyError('Unknown city: %r' % (name,))
+
+# Function to get an observer for a city.  Callers set the observer's date, so they
+# each get their own copy of the remembered one.
+def get_site(name):
+    o = _find_site(name)
+    c = ephem.Observer()
+    c.name = o.name
+    c.lat, c.lon, c.elevation = o.lat, o.lon, o.elevation
+    c.pressure, c.temp, c.horizon = o.pressure, o.temp, o.horizon
+    return c
+
+# Parse a body's elements in XEphem database format, remembering the result for each
+# entry so it only needs to be parsed once.  Computing a body changes it, so callers
+# get their own copy of the parsed one.
+@functools.lru_cache(maxsize=256)
+def _parse_db(db):
+    return ephem.readdb(db)
+
+def read_db(db):
+    return _parse_db(db).copy()
+
 # Function to format a right asenscion angle as hours and minutes
 def fmt_ra(angle):
-    hf = 12 * angle / math.pi
+    hf = angle * _RAD2HR
     h = int(hf)        # Hours of RA
     m = (hf - h) * 60  # Minutes of RA
-    return "{:2d}h{:.0f}m".format(h,m)
+    return f"{h:2d}h{m:.0f}m"
 
 # Function to fully display a datetime object (the way I like to see it :-)
 def fmt_fulldatetime(dttm):
-    return "{:02d}/{:02d}/{:02d} {:02d}:{:02d}:{:02d}".format(
-        dttm.month,dttm.day,dttm.year,
-        dttm.hour,dttm.minute,dttm.second)
+    return (f"{dttm.month:02d}/{dttm.day:02d}/{dttm.year:02d} "
+            f"{dttm.hour:02d}:{dttm.minute:02d}:{dttm.second:02d}")
 
 # Function to format a datetime object just as day/mo + hr:min
 def fmt_datetime(dttm):
-    return "{:02d}/{:02d} {:02d}:{:02d}".format(dttm.month,dttm.day,dttm.hour,dttm.minute)
+    return f"{dttm.month:02d}/{dttm.day:02d} {dttm.hour:02d}:{dttm.minute:02d}"
 
 # Function to format angle (in radians) as dd:mm
 def fmt_angle(a):
-    a = 180 * a / math.pi # convert radians to degrees
-    deg = int(a)
-    min = int( ((a - deg) * 60) + 0.5)
-    return "{:3d}:{:02d}".format(deg,min)
+    # Round to whole minutes of arc once, then split into degrees and minutes.  Do
+    # that on the magnitude so negative angles read as e.g. -4:09 (not -4:-8).
+    total = int(round(a * _RAD2ARCMIN))
+    deg, mn = divmod(abs(total), 60)
+    sign = "-" if total < 0 else ""
+    return f"{sign + str(deg):>3s}:{mn:02d}"
 
 # Function to format a Date object the way I like to see it
 def fmt_date(date):
-    d = date.tuple()
-    return "{:02d}/{:02d}/{:02d} {:02d}:{:02d}:{:04.1f}".format(
-        d[1],d[2],d[0],d[3],d[4],d[5])
+    y, mo, d, h, mi, s = date.tuple()
+    return f"{mo:02d}/{d:02d}/{y:02d} {h:02d}:{mi:02d}:{s:04.1f}"
 
 # Function to format a Date object just as m/d h:m
 def fmt_shortdate(date):
-    d = date.tuple()
-    return "{:02d}/{:02d} {:02d}:{:02d}".format(
-        d[1],d[2],d[3],d[4])
+    y, mo, d, h, mi, s = date.tuple()
+    return f"{mo:02d}/{d:02d} {h:02d}:{mi:02d}"
 
 # Function to generate the output table entry for a body at a specific location.  Note
 # that the location object contains the specific time of interest (location.date)
-def print_visinfo(body,location):
+#
+# PyEphem (4.x) finds risings and settings by estimating the hour angle at which the
+# body crosses the horizon from its declination and the observer's latitude, then
+# refining that with a few Newton steps, so each search is already cheap.
+def compute_visinfo(body,location):
     body.compute(location) # Compute the viewing details
+    # Location-based rise/set modifies the body's attributes, so do those searches with
+    # a copy.  That leaves body as computed here, both for this table entry and for
+    # anyone using it afterwards, without having to compute it all over again.
+    riset = body.copy()
     # Handle the case when the body is above the horizon (so already rose)
     if body.alt > 0:
         # Body might have risen yesterday (is circumpolar)
         try:
-            body_rise = ephem.localtime(location.previous_rising(body))
+            body_rise = ephem.localtime(location.previous_rising(riset))
             r_time = fmt_datetime(body_rise)
         except ephem.CircumpolarError:
             r_time = "already up "
 
         # Body might not set today (is circumpolar)
         try:
-            body_set  = ephem.localtime(location.next_setting(body))
+            body_set  = ephem.localtime(location.next_setting(riset))
             s_time = fmt_datetime(body_set)
         except ephem.CircumpolarError:
             s_time = "doesn't set"
-        # Location-based rise/set modifies body attributes, so need to recompute
-        body.compute(location)
-        print("{:.<19.19s}| Yes | {} | {} | {} | {} | {:5.1f} | {} | {} |".format(body.name, 
-            fmt_angle(body.alt),fmt_angle(body.az), r_time, s_time, body.mag, fmt_ra(body.ra), fmt_angle(body.dec)))
+        return "{:.<19.19s}| Yes | {} | {} | {} | {} | {:5.1f} | {} | {} |".format(body.name, 
+            fmt_angle(body.alt),fmt_angle(body.az), r_time, s_time, body.mag, fmt_ra(body.ra), fmt_angle(body.dec))
     else:
         # If the body isn't visible either it hasn't yet risen today, or it already set today
-        body_rise = ephem.localtime(location.next_rising(body))
-        body_set  = ephem.localtime(location.next_setting(body))
-        # Location-based rise/set modifies body attributes, so need to recompute
-        body.compute(location)
+        body_rise = ephem.localtime(location.next_rising(riset))
+        body_set  = ephem.localtime(location.next_setting(riset))
         r_time = fmt_datetime(body_rise)
         s_time = fmt_datetime(body_set)
-        print("{:.<19.19s}| No  |   ---  |   ---  | {} | {} |  ---  |  ----  |  ----  |".format(body.name,r_time,s_time))
+        return "{:.<19.19s}| No  |   ---  |   ---  | {} | {} |  ---  |  ----  |  ----  |".format(body.name,r_time,s_time)
+
+# And a convenience function to print that table entry
+def print_visinfo(body,location):
+    print(compute_visinfo(body,location))
+
+
+# Function to find the pairs of bodies within threshold (in radians) of each other,
+# as a list of (name, name, separation) in the order the bodies were given
+def close_pairs(bodies,threshold):
+    if len(bodies) >= _NUMPY_MIN_BODIES:
+        try:
+            return _close_pairs_numpy(bodies,threshold)
+        except ImportError:
+            pass # No NumPy, so check the pairs one at a time instead
+    pairs = []
+    for i in range(len(bodies)):
+        for j in range(i+1,len(bodies)):
+            sep = ephem.separation( (bodies[i].az,bodies[i].alt), (bodies[j].az,bodies[j].alt) )
+            if sep < threshold:
+                pairs.append((bodies[i].name, bodies[j].name, sep))
+    return pairs
+
+# Same as close_pairs, but computing the angular separation between every pair of
+# bodies in one go with NumPy (same spherical law of cosines used by ephem.separation)
+def _close_pairs_numpy(bodies,threshold):
+    import numpy as np
+
+    # Pull out just what the search needs (position and name) into separate arrays,
+    # one entry per body, so the math below works on contiguous float arrays rather
+    # than going back to each body object for every pair.
+    n = len(bodies)
+    bodies_az = np.fromiter((b.az for b in bodies), dtype=np.float64, count=n)
+    bodies_alt = np.fromiter((b.alt for b in bodies), dtype=np.float64, count=n)
+    bodies_name = np.array([b.name for b in bodies], dtype=object)
+
+    sin_alt = np.sin(bodies_alt)
+    cos_alt = np.cos(bodies_alt)
+    cos_sep = (sin_alt[:,None] * sin_alt[None,:] +
+        cos_alt[:,None] * cos_alt[None,:] * np.cos(bodies_az[:,None] - bodies_az[None,:]))
+    sep = np.arccos(np.clip(cos_sep, -1.0, 1.0))
+
+    # Only look at each pair once (i < j), and only keep the close ones
+    i_idx, j_idx = np.triu_indices(n, 1)
+    close = sep[i_idx, j_idx] < threshold
+    i_idx, j_idx = i_idx[close], j_idx[close]
+    return list(zip(bodies_name[i_idx], bodies_name[j_idx], sep[i_idx, j_idx]))
 
 
 # ----- Main program functionality starts here -----
 
 # Opening and load JSON file enumeriating additonal objects and data of interest.
 # This includes additional cities to use in calculating ephemerides
-f = open(_objects_file)
-config_data = json.load(f)
-# Close the objects file
-f.close()
+with open(_objects_file, 'rb') as f:
+    config_data = _json_loads(f.read())
 
 # Before calculating anything, add additional cites from the local config file to our
-# custom list
-_mycity_data = {}
-try:
-    objects = config_data['cities']
-    for i in objects:
-        city = { i['name'] : (str(i['latitude']), str(i['longitude']), i['elevation'] ) }
-        _mycity_data.update(city);
-    # print(_mycity_data)
-except KeyError:
-    # No 'cities' included in object listing'
-    pass
+# custom list (which is empty if no 'cities' are included in the object listing)
+_mycity_data = { i['name'] : (str(i['latitude']), str(i['longitude']), i['elevation'])
+    for i in config_data.get('cities', []) }
 
-# See if a different default city is specified in the config file.
-try:
-    city = config_data['default_city']
-    _default_city = city
-except KeyError:
-    # Use fallback default city defined above.
-    pass
+# See if a different default city is specified in the config file, otherwise use
+# the fallback default city defined above.
+_default_city = config_data.get('default_city', _default_city)
 
 
 # Create the argument parser.  Use the default city determined above either from 
@@ -162,14 +256,9 @@ args = parser.parse_args()
 # Look up the observer's city using both the list built into PyEphem and our own
 # private one defined here.  
 try:
-    site = ephem.city(args.city)
+    site = get_site(args.city)
 except KeyError:
-    try:
-        site = additional_city(args.city)
-    except:
-        print("City '{}' not found in global or local list".format(args.city))
-        exit(0)
-        
+    sys.exit("City '{}' not found in global or local list".format(args.city))
 
 # Get current time and use that for our observer.  Note that the result of
 # ephem.now() is a time in UT so it isn't location dependent.  However, the 
@@ -189,20 +278,19 @@ site.date = now
 print("***** Currently at {} ({}) *****".format(site.name,
     fmt_fulldatetime(ephem.localtime(site.date))))
 
-# First do Sun and Moon
-s = ephem.Sun(site)
-m = ephem.Moon(site)
-# Observer-based rise/set calculations modifies the body involved, so need to create
-# 'disposable' ones we don't mind having modififed
-s_loc = ephem.Sun(site)
-m_loc = ephem.Moon(site)
+# First do Sun and Moon.  No need to compute them here since print_visinfo() does
+# that, and it leaves each body computed for our site (it does its rise/set searches
+# with a copy) so we can keep using the same objects afterwards for lunar phase and
+# conjunctions.
+s = ephem.Sun()
+m = ephem.Moon()
 
 
 print("\n*** Sun and Moon ***")
 print("       BODY        | VIS |   ALT  |   AZ   |    RISE     |     SET     |  MAG  |   RA   |   DEC  |")
 print("-------------------+-----+--------+--------+-------------+-------------+-------+--------+--------+")
-print_visinfo(s_loc,site)
-print_visinfo(m_loc,site)
+print_visinfo(s,site)
+print_visinfo(m,site)
 print("-------------------+-----+--------+--------+-------------+-------------+-------+--------+--------+")
 
 print("\n*** Lunar Phase information: ***")
@@ -213,18 +301,18 @@ next_full = ephem.next_full_moon(now)
 next_last = ephem.next_last_quarter_moon(now)
 
 phase = m.moon_phase
+# Use the actual length of this lunation rather than the mean synodic month, which
+# can be off by several hours.  We need next_new for the listing below anyway.
 lunation = (now-prev_new)/(next_new-prev_new)
-# Elaborate on most recent lunar phase
+# Elaborate on most recent lunar phase, which is picked by which quarter of the
+# lunation we're in.  We already know when the previous new moon was, so only search
+# for one of the other phases if that's the most recent.
 
 print("Current lunar illumination is {:0.1f}%, lunation is {:0.4f}".format(phase*100,lunation))
-if lunation < 0.25:
-    print("Was just New Moon at {} UT".format(fmt_date(ephem.previous_new_moon(now))))
-elif lunation < 0.5:
-    print("Was just First Quarter at {} UT".format(fmt_date(ephem.previous_first_quarter_moon(now))))
-elif lunation < 0.75:
-    print("Was just Full Moon at {} UT".format(fmt_date(ephem.previous_full_moon(now))))
-else:
-    print("Was just Last Quarter at {} UT".format(fmt_date(ephem.previous_last_quarter_moon(now))))
+quarter = min(int(lunation * 4), 3)
+label, previous_phase = _PHASE_TABLE[quarter]
+print("Was just {} at {} UT".format(label,
+    fmt_date(prev_new if quarter == 0 else previous_phase(now))))
 
 print("New Moon     : {} UT ({} Local time)".format(
     fmt_date(next_new),fmt_fulldatetime(ephem.localtime(next_new))))
@@ -244,17 +332,12 @@ saturn  = ephem.Saturn()
 uranus  = ephem.Uranus()
 neptune = ephem.Neptune()
 pluto   = ephem.Pluto()
+planets = [mercury, venus, mars, jupiter, saturn, uranus, neptune, pluto]
 
 print("       BODY        | VIS |   ALT  |   AZ   |    RISE     |     SET     |  MAG  |   RA   |   DEC  |")
 print("-------------------+-----+--------+--------+-------------+-------------+-------+--------+--------+")
-print_visinfo(mercury,site)
-print_visinfo(venus,site)
-print_visinfo(mars,site)
-print_visinfo(jupiter,site)
-print_visinfo(saturn,site)
-print_visinfo(uranus,site)
-print_visinfo(neptune,site)
-print_visinfo(pluto,site)
+for planet in planets:
+    print_visinfo(planet,site)
 print("-------------------+-----+--------+--------+-------------+-------------+-------+--------+--------+")
 
 # Look for conjunctions
@@ -264,22 +347,17 @@ print("-------------------+-----+--------+--------+-------------+-------------+-
 
 # Create a body for M45 (The Pleiades) by parsing its attributes in XEphem format
 m45_x = "M45,f|U,3:47:0,24:07:0,1.6,2000,0"
-m45 = ephem.readdb(m45_x)
+m45 = read_db(m45_x)
 m45.compute(site) # Compute observation values for our specified site
 
-bodies = [s, m, mercury, venus, mars, jupiter, saturn, uranus, neptune, pluto, m45 ]
-n = len(bodies)
-count = 0
-threshold = 15.0 * math.pi / 180.0  # 15 degrees
+bodies = [s, m] + planets + [m45]
+threshold = 15.0 * _DEG2RAD  # 15 degrees
 
-for i in range(n):
-    for j in range(i+1,n):
-        sep = ephem.separation( (bodies[i].az,bodies[i].alt), (bodies[j].az,bodies[j].alt) )
-        if sep < threshold:
-            if count == 0:
-                print("\n*** Close Approaches (may not be visible) ***")
-            print("{:7s} to {:7s} = {} (dd:mm)".format(bodies[i].name,bodies[j].name, fmt_angle(sep)))
-            count = count + 1
+pairs = close_pairs(bodies,threshold)
+if pairs:
+    print("\n*** Close Approaches (may not be visible) ***")
+for name_i, name_j, sep in pairs:
+    print("{:7s} to {:7s} = {} (dd:mm)".format(name_i, name_j, fmt_angle(sep)))
 
 
 # Handle special objects such as comets.  A great source of orbital element info is
@@ -312,7 +390,7 @@ try:
     for i in objects:
         if i['display']:
             comet_x = i['db_info']
-            comet = ephem.readdb(comet_x)
+            comet = read_db(comet_x)
             print_visinfo(comet,site)
     print("-------------------+-----+--------+--------+-------------+-------------+-------+--------+--------+")
 except KeyError: